@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
+import asyncio
 import getopt
 import random
+import signal
 import sys
+from typing import Set
 
 import discord
 
 import lib.token_handler
+from lib.circuit_breaker import probe_loop
 from lib.config import get_config
 from lib.event_handler import EventHandler
+from lib.gateway import create_client, memory_report_loop
+from lib.lanes import lane_report_loop
 from lib.misc_functions import add_random_reaction
+from lib.watchdog import start_watchdog
 
 
 def print_usage() -> None:
@@ -36,6 +43,10 @@ if __name__ == "__main__":
     try:
         random_reactions = get_config("random_reactions") == "true"
         reaction_frequency = 1 - float(get_config("reaction_frequency"))
+        memory_report_interval = int(get_config("memory_report_interval"))
+        lane_report_interval = int(get_config("lane_report_interval"))
+        circuit_breaker_probe_interval = float(get_config("circuit_breaker_probe_interval"))
+        client = create_client()
     except Exception:
         print("Error parsing config file. Please ensure config/config.ini exists and is proper format")
         sys.exit(1)
@@ -64,18 +75,34 @@ if __name__ == "__main__":
         print_usage()
         sys.exit(1)
 
-    intents = discord.Intents.none()
-    intents.guilds = True
-    intents.messages = True
-    intents.reactions = True
-    intents.message_content = True
-    client = discord.Client(intents=intents)
     handler = EventHandler()
+    background_tasks: Set["asyncio.Task[None]"] = set()
+
+    @client.event
+    async def setup_hook() -> None:
+        loop = asyncio.get_running_loop()
+        watchdog = start_watchdog(loop)
+        if watchdog:
+            # Operators can take a sampling profile of the running bot with `kill -USR1 <pid>`
+            loop.add_signal_handler(signal.SIGUSR1, watchdog.start_profile)
+        if memory_report_interval > 0:
+            task = asyncio.create_task(memory_report_loop(client, memory_report_interval))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        if lane_report_interval > 0:
+            task = asyncio.create_task(lane_report_loop(handler.lanes, lane_report_interval))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        task = asyncio.create_task(probe_loop(circuit_breaker_probe_interval))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
     @client.event
     async def on_ready() -> None:
+        # on_ready fires again after every gateway reconnect, but everything only needs to be started once
+        if handler.initialized:
+            return
         handler.initialize(client)
-        await client.change_presence(activity=discord.Game("Bepis"))
         if client.user:
             print("Logged in as {}".format(client.user.name))
             print("Invite Link: https://discordapp.com/oauth2/authorize?client_id={}&scope=bot&permissions=2048".format(client.user.id))
@@ -89,12 +116,26 @@ if __name__ == "__main__":
         await handler.handle_message(message)
 
     @client.event
-    async def on_reaction_add(reaction: discord.Reaction, user: discord.User) -> None:
-        await handler.handle_reaction_add(reaction, user)
+    async def on_raw_reaction_add(payload: discord.RawReactionActionEvent) -> None:
+        # Raw events also fire for messages which aren't in the (usually disabled) message cache
+        await handler.handle_reaction_add(payload)
+
+    async def run_bot(token: str) -> None:
+        # Shut down cleanly (saving reminders) on SIGTERM as well as Ctrl+C
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: background_tasks.add(asyncio.create_task(client.close())))
+        try:
+            async with client:
+                await client.start(token)
+        finally:
+            print("Shutting down...")
+            await handler.close()
 
     print("Logging in and starting up...")
+    discord.utils.setup_logging()
     try:
-        client.run(token)
+        asyncio.run(run_bot(token))
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         print(e)
         sys.exit(1)
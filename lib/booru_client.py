@@ -1,25 +1,77 @@
+import asyncio
 import math
+import threading
 import urllib.parse
-from typing import TYPE_CHECKING, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
 
+import discord
 import requests
 
+from lib.circuit_breaker import get_breaker
 from lib.config import get_config
+from lib.tracked_messages import tracked_messages
 from lib.utils import get_params
 
 if TYPE_CHECKING:
-    from discord import Message
+    from discord import Message, PartialMessage
     from discord.abc import MessageableChannel
 
 
+danbooru_host = "danbooru.donmai.us"
+unavailable_message = "Danbooru is unavailable right now. Try again in a bit"
+# Reacting with this to a danr result replaces it with a new image for the same tags
+reroll_emoji = "\U0001f501"
+# Danbooru won't return more than this many posts for a single request
+page_limit = 200
+# Maximum number of rounds of page requests for one request before giving up on filling it
+max_rounds = 3
+# Only fetch the post fields that are used for filtering to keep the response small
+post_fields = "id,file_url,file_ext,file_size,rating"
+# Weight of the newest request when updating the bad result ratio of a tag set
+bad_ratio_weight = 0.3
+# Never assume more than this ratio of bad results, so a bad streak can't blow up the request size
+max_bad_ratio = 0.75
+# Maximum number of tag sets to remember bad result ratios for
+max_tracked_tag_sets = 1000
+
 use_account: Optional[bool] = None
 account_login: str = ""
 api_key: str = ""
+max_amount: int = 0
+max_concurrency: int = 0
+host_semaphores: Dict[str, asyncio.Semaphore] = {}
+session = requests.Session()
+session.headers["User-Agent"] = "yet-another-discord-bot"
+allowed_extensions: Set[str] = set()
+allowed_ratings: Set[str] = set()
+max_file_size: int = 0
+timeout: float = 0
+reroll: bool = False
+# Moving average of the ratio of filtered out posts for each tag set
+bad_ratios: Dict[str, float] = {}
+bad_ratios_lock = threading.Lock()
 
 
 def _init_config_if_necesary() -> None:
     global use_account
     if use_account is None:
+        global max_amount
+        global max_concurrency
+        max_amount = int(get_config("danbooru_max_amount"))
+        max_concurrency = int(get_config("danbooru_max_concurrency"))
+        # Keep a pooled connection for each page request that can run at the same time
+        session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max_concurrency))
+        get_breaker(danbooru_host, probe=probe_danbooru)
+        global allowed_extensions
+        global allowed_ratings
+        global max_file_size
+        allowed_extensions = {ext.strip().lower() for ext in get_config("danbooru_allowed_extensions").split(",") if ext.strip()}
+        allowed_ratings = {rating.strip().lower() for rating in get_config("danbooru_allowed_ratings").split(",") if rating.strip()}
+        max_file_size = int(get_config("danbooru_max_file_size"))
+        global timeout
+        global reroll
+        timeout = float(get_config("danbooru_timeout"))
+        reroll = get_config("danbooru_reroll") == "true"
         use_account = get_config("danbooru_account") == "true"
         if use_account:
             global account_login
@@ -28,6 +80,25 @@ def _init_config_if_necesary() -> None:
             api_key = get_config("danbooru_api_key")
 
 
+def probe_danbooru() -> None:
+    """
+    Make a minimal request to danbooru to check if it has recovered, for the circuit breaker
+
+    Raises:
+        requests.RequestException when danbooru is still unreachable or returning server errors
+    """
+    r = session.get("https://{}/posts.json".format(danbooru_host), params="limit=1&only=id", timeout=timeout)
+    if r.status_code >= 500:
+        r.raise_for_status()
+
+
+def close() -> None:
+    """
+    Close the pooled HTTP connections of the booru client
+    """
+    session.close()
+
+
 async def handle_danr(message: "Message", trigger_type: str, trigger: str) -> None:
     """
     Handle the booru danr request
@@ -37,7 +108,6 @@ async def handle_danr(message: "Message", trigger_type: str, trigger: str) -> No
         trigger_type: the trigger type that called this function ('author', 'first_word', or 'contains')
         trigger: the relevant string from the message that triggered this call
     """
-    await message.channel.typing()
     await process_request(message.channel, 1, get_params(message))
 
 
@@ -60,7 +130,6 @@ async def handle_spam(message: "Message", trigger_type: str, trigger: str) -> No
         await message.channel.send("Usage: `spam <amount> <optional space seperated tags>`")
         return
     params = params[1:]
-    await message.channel.typing()
     await process_request(message.channel, amount, params)
 
 
@@ -74,65 +143,269 @@ async def process_request(channel: "MessageableChannel", amount: int, params: Li
         params: List of tags (Note: danbooru has max limit of 1 with random for anonymous/free accounts)
     """
     _init_config_if_necesary()
+    # Fail fast without waiting on danbooru when it is known to be down
+    if not get_breaker(danbooru_host).is_available():
+        await channel.send(unavailable_message)
+        return
+    await channel.typing()
     warning = ""
-    if amount > 200:
-        warning = ":warning:Note: Danbooru doesn't allow requests over 200 in size. This request will be limited"
+    if amount > max_amount:
+        warning = ":warning:Note: Requests are limited to {} images. This request will be limited".format(max_amount)
+        amount = max_amount
     if not use_account and len(params) > 1:
         warning = ":warning:Note: Danbooru doesn't allow searching on more than 1 random tag at once. Search will be limited to your first tag"
         params = params[:1]
     if warning:
         await channel.send(warning)
     print("[BOORU_CLIENT] Request for {} images with tags: {}".format(amount, params))
+    seen: Set[int] = set()
+    sent = 0
+    errors = 0
+    msg = None
+    # Keep requesting pages until the request is filled or a whole round of pages comes back with nothing new
+    for _ in range(max_rounds):
+        remaining = amount - sent
+        pages = [asyncio.create_task(fetch_page(page_amount, params)) for page_amount in split_pages(remaining, params)]
+        round_sent = 0
+        try:
+            # Send each page as soon as it arrives rather than waiting for the slowest one
+            for completed in asyncio.as_completed(pages):
+                try:
+                    posts = await completed
+                except Exception as e:
+                    print("[BOORU_CLIENT] Request threw an exception:", e)
+                    errors += 1
+                    continue
+                result: List[str] = []
+                for post_id, url in posts:
+                    if post_id not in seen and sent + len(result) < amount:
+                        seen.add(post_id)
+                        result.append(url)
+                if not result:
+                    continue
+                print("[BOORU_CLIENT] Sending back results: {}".format(result))
+                if amount > 1 and msg is None:
+                    msg = await channel.send("Retrieving {} results. Sending as they arrive".format(amount))
+                messages = await send_results(channel, result)
+                if reroll and amount == 1:
+                    try:
+                        await messages[0].add_reaction(reroll_emoji)
+                    except discord.HTTPException as e:
+                        # The result was still sent; it just can't be rerolled
+                        print("[BOORU_CLIENT] WARNING: Couldn't add reroll reaction to result: {}".format(e))
+                    else:
+                        tracked_messages.track(messages[0].id, reroll_emoji, handle_reroll, params)
+                sent += len(result)
+                round_sent += len(result)
+        finally:
+            for page in pages:
+                page.cancel()
+        if sent >= amount or not round_sent:
+            break
+    print("[BOORU_CLIENT] {} proper image url responses.".format(sent))
+    if not sent:
+        if errors and not get_breaker(danbooru_host).is_available():
+            await channel.send(unavailable_message)
+        elif errors:
+            await channel.send("Error while getting content. Maybe the booru api is down or malfunctioning?")
+        else:
+            print("[BOORU_CLIENT] Request had no (or bad) results")
+            await channel.send("No result found. Find better tags: https://www.donmai.us/tags")
+    elif msg is not None:
+        await channel.send("Done", delete_after=1.5)
+        await msg.delete()
+
+
+async def send_results(channel: "MessageableChannel", result: List[str]) -> List["Message"]:
+    """
+    Send image URLs to a channel, 5 per message
+
+    Args:
+        channel: Discord channel model
+        result: List of image URLs to send
+    Returns:
+        List of the sent discord messages
+    """
+    messages = []
+    for x in range(math.ceil(len(result) / 5)):
+        messages.append(await channel.send("\n".join(result[x * 5 : (x * 5) + 5])))
+    return messages
+
+
+async def handle_reroll(message: "PartialMessage", user_id: int, tags: List[str]) -> None:
+    """
+    Handle a reroll reaction on a danr result by replacing it with a new image for the same tags
+
+    Args:
+        message: Discord message object of the danr result
+        user_id: discord id of the user who reacted
+        tags: List of tags of the original request
+    """
+    if not get_breaker(danbooru_host).is_available():
+        return
+    print("[BOORU_CLIENT] Reroll with tags: {}".format(tags))
     try:
-        result = get_danbooru(amount, params)
+        posts = await fetch_page(1, tags)
     except Exception as e:
-        print("[BOORU_CLIENT] Request threw an exception:", e)
-        await channel.send("Error while getting content. Maybe the booru api is down or malfunctioning?")
-        return
-    if not result:
-        print("[BOORU_CLIENT] Request had no (or bad) results")
-        await channel.send("No result found. Find better tags: https://www.donmai.us/tags")
+        print("[BOORU_CLIENT] Reroll threw an exception:", e)
         return
-    else:
-        length = len(result)
-        print("[BOORU_CLIENT] Sending back results: {}".format(result))
-        print("[BOORU_CLIENT] {} proper image url responses.".format(length))
-        if length > 1:
-            msg = await channel.send("Retrieved {} results. Sending now".format(length))
-        for x in range(math.ceil(length / 5)):
-            await channel.send("\n".join(result[x * 5 : (x * 5) + 5]))
-        if length > 1:
-            await channel.send("Done", delete_after=1.5)
-            await msg.delete()
+    if posts:
+        await message.edit(content=posts[0][1])
+
+
+def split_pages(amount: int, tags: List[str]) -> List[int]:
+    """
+    Split an amount of images into amounts which can each be fetched with a single danbooru request
+
+    Args:
+        amount: Integer amount of images to request
+        tags: List of tags
+    Returns:
+        List of amounts to request from each page
+    """
+    pages = []
+    while amount > 0:
+        page_amount = min(amount, page_limit)
+        while page_amount + get_offset(page_amount, tags) > page_limit:
+            page_amount -= 1
+        pages.append(page_amount)
+        amount -= page_amount
+    return pages
+
+
+async def fetch_page(amount: int, tags: List[str]) -> List[Tuple[int, str]]:
+    """
+    Fetch one page of danbooru results without blocking the event loop, limited by the per-host concurrency and circuit breaker
+
+    Args:
+        amount: Integer amount of images to request
+        tags: List of tags
+    Returns:
+        List of (post id, image URL) tuples
+    Raises:
+        RuntimeError when the danbooru circuit breaker is open
+    """
+    semaphore = host_semaphores.get(danbooru_host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        host_semaphores[danbooru_host] = semaphore
+    async with semaphore:
+        breaker = get_breaker(danbooru_host)
+        if not breaker.allow_request():
+            raise RuntimeError("[BOORU_CLIENT] Circuit breaker for {} is open".format(danbooru_host))
+        try:
+            result = await asyncio.to_thread(get_danbooru, amount, tags)
+        except requests.RequestException:
+            # Only connection errors, timeouts, and server errors mean danbooru itself is having problems
+            breaker.record_failure()
+            raise
+        except RuntimeError:
+            # Danbooru answered, the request just wasn't valid
+            breaker.record_success()
+            raise
+        breaker.record_success()
+        return result
+
+
+def get_offset(amount: int, tags: List[str]) -> int:
+    """
+    Get the number of extra posts to request on top of the amount wanted, based on how many bad results this tag set has returned before
+
+    Args:
+        amount: Integer amount of images to request
+        tags: List of tags
+    Returns:
+        Integer amount of extra posts to request
+    """
+    bad_ratio = bad_ratios.get(tag_set_key(tags))
+    if bad_ratio is None:
+        # Request more than we need because sometimes danbooru will return bad results amidst good ones
+        return max([3, math.ceil(amount * 0.25)])
+    # Enough extra for the expected bad results, plus one to absorb small variations
+    return math.ceil(amount / (1 - bad_ratio)) - amount + 1
+
+
+def tag_set_key(tags: List[str]) -> str:
+    """
+    Get the key used to track results of a tag set, independent of tag order and case
+
+    Args:
+        tags: List of tags
+    Returns:
+        String key for the tag set
+    """
+    return " ".join(sorted(tag.lower() for tag in tags))
+
+
+def record_bad_ratio(tags: List[str], total: int, bad: int) -> None:
+    """
+    Update the moving average of filtered out posts for a tag set
+
+    Args:
+        tags: List of tags
+        total: Integer amount of posts returned by danbooru
+        bad: Integer amount of those posts which were filtered out
+    """
+    key = tag_set_key(tags)
+    ratio = min(bad / total, max_bad_ratio)
+    with bad_ratios_lock:
+        previous = bad_ratios.pop(key, None)
+        if previous is not None:
+            ratio = previous + bad_ratio_weight * (ratio - previous)
+        elif len(bad_ratios) >= max_tracked_tag_sets:
+            # Dicts keep insertion order and entries are reinserted when updated, so the first one is the least recently used
+            del bad_ratios[next(iter(bad_ratios))]
+        bad_ratios[key] = ratio
+
+
+def is_allowed(post: Dict[str, Any]) -> bool:
+    """
+    Check a danbooru post against the configured media policy
+
+    Args:
+        post: Post dictionary from the danbooru api
+    Returns:
+        True if the post has a file which can be sent, False otherwise
+    """
+    if not post.get("file_url"):
+        return False
+    if allowed_extensions and str(post.get("file_ext", "")).lower() not in allowed_extensions:
+        return False
+    if allowed_ratings and str(post.get("rating", "")).lower() not in allowed_ratings:
+        return False
+    if max_file_size and post.get("file_size", 0) > max_file_size:
+        return False
+    return True
 
 
-def get_danbooru(amount: int, tags: List[str]) -> List[str]:
+def get_danbooru(amount: int, tags: List[str]) -> List[Tuple[int, str]]:
     """
-    Makes an http call to the danbooru api, returning an array of image URLs
+    Makes an http call to the danbooru api, returning an array of post IDs and image URLs
 
     Args:
         amount: Integer amount of images to request
         tags: List of tags (Note: danbooru has max limit of 1 with random for anonymous/free accounts)
     Returns:
-        List of image URLs matching search with length <= amount. Empty if no results
+        List of (post id, image URL) tuples matching search with length <= amount. Empty if no results
     """
-    offset = max([3, math.ceil(amount * 0.25)])
-    # Request more than we need because sometimes danbooru will return bad results amidst good ones
-    limit = amount + offset
+    limit = min(amount + get_offset(amount, tags), page_limit)
     req_tags = tags.copy()
     req_tags.append("random:{}".format(limit))
     params = {
         "limit": limit,
         "tags": "+".join(req_tags),
+        "only": post_fields,
     }
     if use_account:
         params["login"] = account_login
         params["api_key"] = api_key
-    r = requests.get(
-        "https://danbooru.donmai.us/posts.json",
+    r = session.get(
+        "https://{}/posts.json".format(danbooru_host),
         params=urllib.parse.urlencode(params, safe=":+"),
-        headers={"User-Agent": "yet-another-discord-bot"},
+        timeout=timeout,
     )
+    if r.status_code >= 500:
+        r.raise_for_status()
     if not r.ok:
         raise RuntimeError("[BOORU_CLIENT] HTTP {}: {}".format(r.status_code, r.text[:200]))
     response = r.json()
@@ -142,14 +415,7 @@ def get_danbooru(amount: int, tags: List[str]) -> List[str]:
         print("[BOORU_CLIENT] Request had no results")
         return []
     else:
-        results = []
-        count = 0
         print("[BOORU_CLIENT] {} hits".format(len(response)))
-        for item in response:
-            url = item.get("file_url")
-            if url and (not url.endswith(".zip")):
-                results.append(url)
-                count += 1
-                if count >= amount:
-                    break
-        return results
+        results = [(item["id"], item["file_url"]) for item in response if is_allowed(item)]
+        record_bad_ratio(tags, len(response), len(response) - len(results))
+        return results[:amount]
@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from lib.config import get_config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """Tracks failures of an upstream service and fails fast while it is down"""
+
+    def __init__(self, name: str, failure_threshold: int, probe_interval: float, probe: Optional[Callable[[], None]] = None):
+        """
+        Constructor for the circuit breaker
+
+        Args:
+            name: name of the upstream service this breaker protects
+            failure_threshold: number of consecutive failures before the breaker opens
+            probe_interval: seconds to wait while open before letting a probe request through
+            probe: blocking function which checks the upstream in the background while open, raising if it is still down.
+                Without one, the breaker is only probed by requests users make
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.probe = probe
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        # Totals of requests made to the upstream, for monitoring error rates
+        self.total_requests = 0
+        self.total_failures = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """
+        Check if a request to the upstream should be made. While open, one probe request is allowed every probe_interval
+
+        Returns:
+            True if the request should be made, False if it should fail fast
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            # A probe which never reported back doesn't block the next one
+            if time.time() - self.opened_at >= self.probe_interval:
+                self.opened_at = time.time()
+                if self.state != HALF_OPEN:
+                    self._set_state(HALF_OPEN)
+                return True
+            return False
+
+    def is_available(self) -> bool:
+        """
+        Check if requests to the upstream would currently be allowed, without taking the probe slot
+
+        Returns:
+            True if the breaker is closed or due for a probe, False otherwise
+        """
+        with self.lock:
+            return self.state == CLOSED or time.time() - self.opened_at >= self.probe_interval
+
+    def record_success(self) -> None:
+        """
+        Record a successful request to the upstream, closing the breaker
+        """
+        with self.lock:
+            self.total_requests += 1
+            self.failures = 0
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self) -> None:
+        """
+        Record a failed or timed out request to the upstream, opening the breaker if the failure threshold was reached
+        """
+        with self.lock:
+            self.total_requests += 1
+            self.total_failures += 1
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self._set_state(OPEN)
+
+    def run_probe(self) -> None:
+        """
+        Check if the upstream has recovered with the probe function, if this breaker has one and is due for a probe
+        """
+        if self.probe is None or self.state == CLOSED or not self.allow_request():
+            return
+        try:
+            self.probe()
+        except Exception as e:
+            print("[CIRCUIT_BREAKER] Probe of {} failed: {}".format(self.name, e))
+            self.record_failure()
+            return
+        self.record_success()
+
+    def _set_state(self, state: str) -> None:
+        print("[CIRCUIT_BREAKER] {} circuit changed from {} to {}".format(self.name, self.state, state))
+        if state == OPEN:
+            print("[CIRCUIT_BREAKER] WARNING: {} is unavailable after {} failures".format(self.name, self.failures))
+        self.state = state
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str, probe: Optional[Callable[[], None]] = None) -> CircuitBreaker:
+    """
+    Get the circuit breaker for an upstream service, creating it from the config if necessary
+
+    Args:
+        name: name of the upstream service
+        probe: blocking function which checks the upstream in the background while the breaker is open (see CircuitBreaker)
+    Returns:
+        CircuitBreaker object shared by all users of this upstream
+    """
+    with breakers_lock:
+        breaker = breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, int(get_config("circuit_breaker_threshold")), float(get_config("circuit_breaker_probe_interval")))
+            breakers[name] = breaker
+        if probe is not None:
+            breaker.probe = probe
+        return breaker
+
+
+def get_breaker_states() -> Dict[str, Tuple[str, int, int]]:
+    """
+    Get the state and request totals of every circuit breaker, for monitoring
+
+    Returns:
+        Dictionary of upstream name to a tuple of (state ('closed', 'open', or 'half_open'), total requests, total failures)
+    """
+    with breakers_lock:
+        current = list(breakers.items())
+    states = {}
+    for name, breaker in current:
+        with breaker.lock:
+            states[name] = (breaker.state, breaker.total_requests, breaker.total_failures)
+    return states
+
+
+async def probe_loop(interval: float) -> None:
+    """
+    Periodically probe every open circuit breaker which has a probe function, so a recovered upstream is noticed without waiting for user requests
+
+    Args:
+        interval: seconds between checks of the breakers
+    """
+    while True:
+        await asyncio.sleep(interval)
+        with breakers_lock:
+            current = list(breakers.values())
+        for breaker in current:
+            await asyncio.to_thread(breaker.run_probe)
@@ -1,9 +1,12 @@
+import asyncio
 import random
 import time
 from typing import TYPE_CHECKING, Any, Dict
 
 import requests
 
+from lib.circuit_breaker import get_breaker
+
 if TYPE_CHECKING:
     from discord import Message
 
@@ -22,6 +25,16 @@ class Cleverbot(object):
         self.apikey = apikey
         self.conversations: Dict[int, Dict[str, Any]] = {}
         self.timeout = 30
+        self.session = requests.Session()
+        # Every cleverbot request is billed, so this breaker has no background probe and is only probed by user requests
+        self.breaker = get_breaker("cleverbot")
+        self.unavailable_message = "Sorry, I am asleep (actually I'm probably just broken)"
+
+    def close(self) -> None:
+        """
+        Close the pooled HTTP connections of this client
+        """
+        self.session.close()
 
     async def handle_cleverbot(self, message: "Message", trigger_type: str, trigger: str) -> None:
         """
@@ -32,6 +45,10 @@ class Cleverbot(object):
             trigger_type: the trigger type that called this function ('author', 'first_word', or 'contains')
             trigger: the relevant string from the message that triggered this call
         """
+        # Fail fast without waiting on cleverbot when it is known to be down
+        if not self.breaker.allow_request():
+            await message.channel.send(self.unavailable_message)
+            return
         await message.channel.typing()
         await self.process_request(message)
 
@@ -60,7 +77,14 @@ class Cleverbot(object):
         # Now make the request with our params
         try:
             print("[CLEVER_BOT] {}: {}".format(message.author.__str__(), params["input"]))
-            r = requests.get(url=self.base_url, params=params, timeout=self.timeout)
+            try:
+                r = await asyncio.to_thread(self.session.get, url=self.base_url, params=params, timeout=self.timeout)
+                if r.status_code >= 500:
+                    r.raise_for_status()
+            except requests.RequestException:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
             # print(r.text)
             if r.status_code != 200:
                 raise RuntimeError("Bad response from cleverbot: {}".format(r.status_code))
@@ -75,4 +99,4 @@ class Cleverbot(object):
             self.conversations[message.channel.id] = convo
         except Exception as e:
             print("[CLEVER_BOT] Error making call: {}".format(e))
-            await message.channel.send("Sorry, I am asleep (actually I'm probably just broken)")
+            await message.channel.send(self.unavailable_message)
@@ -1,34 +1,59 @@
-from typing import TYPE_CHECKING, Set
+import asyncio
+import functools
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Set
 
+import lib.booru_client
 import lib.misc_functions
-from lib.booru_client import handle_danr, handle_spam
+import lib.waifu_client
+import lib.watchdog
+from lib.booru_client import handle_danr, handle_reroll, handle_spam
+from lib.circuit_breaker import get_breaker_states
 from lib.cleverbot_client import Cleverbot
 from lib.config import get_config
+from lib.gateway import get_cache_counts, get_rss_bytes
+from lib.lanes import EXTERNAL_API, INSTANT, LOCAL_IO, create_lanes
 from lib.remind_client import Reminder
+from lib.stats import HandlerTimings, pool_usage
+from lib.tracked_messages import TrackedMessage, tracked_messages
 from lib.waifu_client import handle_waifu
+from lib.watchdog import running_handler
 
 if TYPE_CHECKING:
-    from discord import Client, Message, Reaction, User
+    from discord import Client, Message, PartialMessage, RawReactionActionEvent
 
 
 class EventHandler(object):
+    def __init__(self) -> None:
+        """
+        Constructor for the EventHandler
+        """
+        self.lanes = create_lanes()
+        self.initialized = False
+        self.clever: Optional[Cleverbot] = None
+        self.remind: Optional[Reminder] = None
+        self.timings = HandlerTimings()
+
     def initialize(self, client: "Client") -> None:
         """
-        Initialize this EventHandler
+        Initialize this EventHandler and start its integrations. Only the first call does anything, so this is safe to call on every (re)connect
 
         Args:
             client: Ready Discord client object
         Raises:
             RuntimeError when passed discord client is not ready
         """
+        if self.initialized:
+            return
         if not client.is_ready() or not client.user:
             raise RuntimeError("Discord client passed into EventHandler was not ready for use")
+        self.initialized = True
         self.client = client
         self.user = client.user
         # Make sure each of the entries in these arrays have an entry in the function_map dictionary for their relevant functions
         self.msg_author_triggers: Set[str] = set()
         self.msg_contains_triggers: Set[str] = set()
-        self.msg_first_word_triggers = {"danr", "spam", "choose"}
+        self.msg_first_word_triggers = {"danr", "spam", "choose", "stats"}
         if get_config("linux_nag") == "true":
             self.msg_contains_triggers.add("linux")
         if get_config("waifulist_integration") == "true":
@@ -40,11 +65,25 @@ class EventHandler(object):
             "spam": handle_spam,
             "linux": lib.misc_functions.linux_saying,
             "choose": lib.misc_functions.handle_choose,
+            "stats": self.handle_stats,
             "waifu": handle_waifu,
             "imouto": handle_waifu,
             "oneechan": handle_waifu,
             "oneesan": handle_waifu,
         }
+        # Lane which each trigger's function runs in. Triggers not listed here are cheap and run in the instant lane
+        self.trigger_lanes: Dict[str, str] = {
+            "danr": EXTERNAL_API,
+            "spam": EXTERNAL_API,
+            "waifu": EXTERNAL_API,
+            "imouto": EXTERNAL_API,
+            "oneechan": EXTERNAL_API,
+            "oneesan": EXTERNAL_API,
+        }
+        # Lane which each reaction handler runs in, like trigger_lanes
+        self.reaction_lanes: Dict[Callable[["PartialMessage", int, Any], Awaitable[None]], str] = {
+            handle_reroll: EXTERNAL_API,
+        }
 
         try:
             if get_config("cleverbot_integration") == "true":
@@ -55,14 +94,19 @@ class EventHandler(object):
                 self.msg_first_word_triggers.add(self_mention_2)
                 self.function_map[self_mention_1] = self.clever.handle_cleverbot
                 self.function_map[self_mention_2] = self.clever.handle_cleverbot
+                self.trigger_lanes[self_mention_1] = EXTERNAL_API
+                self.trigger_lanes[self_mention_2] = EXTERNAL_API
         except Exception:
             print("WARNING: Error processing cleverbot integration")
 
         try:
             if get_config("remind_enabled") == "true":
                 self.remind = Reminder(self.client)
+                self.remind.start()
                 self.msg_first_word_triggers.add("remind")
                 self.function_map["remind"] = self.remind.handle_remind
+                self.trigger_lanes["remind"] = LOCAL_IO
+                self.reaction_lanes[self.remind.handle_snooze] = LOCAL_IO
         except Exception:
             print("WARNING: Error processing reminder integration")
 
@@ -70,6 +114,19 @@ class EventHandler(object):
         self.add_triggers("contains_triggers", self.msg_contains_triggers)
         self.add_triggers("first_word_triggers", self.msg_first_word_triggers)
 
+    async def close(self) -> None:
+        """
+        Stop the integrations of this EventHandler, waiting for reminders to be saved and HTTP connections to be closed
+        """
+        for lane in self.lanes.values():
+            await lane.stop()
+        if self.remind:
+            await asyncio.to_thread(self.remind.stop)
+        if self.clever:
+            self.clever.close()
+        lib.booru_client.close()
+        lib.waifu_client.close()
+
     def add_triggers(self, config_entry: str, trigger_set: Set[str]) -> None:
         """
         Read bot triggers from a settings configuration entry and make them active for the bot
@@ -104,28 +161,134 @@ class EventHandler(object):
             if message_parts:
                 first_word = message_parts[0].lower()
             if author in self.msg_author_triggers:
-                try:
-                    await self.function_map[author](message, "author", author)
-                except Exception as e:
-                    print("WARNING: Exception thrown during author function call", e)
+                await self.dispatch(message, "author", author)
             if first_word in self.msg_first_word_triggers:
-                try:
-                    await self.function_map[first_word](message, "first_word", first_word)
-                except Exception as e:
-                    print("WARNING: Exception thrown during first_word function call", e)
+                await self.dispatch(message, "first_word", first_word)
             for phrase in self.msg_contains_triggers:
                 if phrase in message.content.lower():
-                    try:
-                        await self.function_map[phrase](message, "contains", phrase)
-                    except Exception as e:
-                        print("WARNING: Exception thrown during contains function call", e)
+                    await self.dispatch(message, "contains", phrase)
+
+    async def dispatch(self, message: "Message", trigger_type: str, trigger: str) -> None:
+        """
+        Queue the function handling a trigger in its lane
+
+        Args:
+            message: Discord message object for this event
+            trigger_type: the trigger type ('author', 'first_word', or 'contains')
+            trigger: the relevant string from the message that triggered this call
+        """
+        lane = self.lanes[self.trigger_lanes.get(trigger, INSTANT)]
+        if not lane.submit(functools.partial(self.call_handler, message, trigger_type, trigger)):
+            print("WARNING: {} lane is full, rejected {} function call for {}".format(lane.name, trigger_type, trigger))
+            if lane.name != INSTANT:
+                await message.channel.send("I'm too busy for that right now. Try again in a bit")
+
+    async def call_handler(self, message: "Message", trigger_type: str, trigger: str) -> None:
+        """
+        Call the function handling a trigger
+
+        Args:
+            message: Discord message object for this event
+            trigger_type: the trigger type ('author', 'first_word', or 'contains')
+            trigger: the relevant string from the message that triggered this call
+        """
+        function = self.function_map[trigger]
+        start = time.perf_counter()
+        try:
+            # Lets the watchdog name the trigger and handler if the handler blocks the event loop
+            with running_handler(trigger_type, trigger, function):
+                await function(message, trigger_type, trigger)
+        except Exception as e:
+            print("WARNING: Exception thrown during {} function call".format(trigger_type), e)
+        finally:
+            self.timings.record(function.__qualname__, time.perf_counter() - start)
+
+    async def handle_stats(self, message: "Message", trigger_type: str, trigger: str) -> None:
+        """
+        Handle the stats request by sending the live performance state of the bot. Only the bot's owner(s) can use this
+
+        Args:
+            message: Discord message object related to this request
+            trigger_type: the trigger type that called this function ('author', 'first_word', or 'contains')
+            trigger: the relevant string from the message that triggered this call
+        """
+        application = self.client.application
+        if application is None:
+            return
+        owner_ids = {member.id for member in application.team.members} if application.team else {application.owner.id}
+        if message.author.id not in owner_ids:
+            return
+        await message.channel.send("```\n{}\n```".format("\n".join(await self.get_stats())))
+
+    async def get_stats(self) -> List[str]:
+        """
+        Collect the performance state of the bot from its always-on counters. The reminder store is read in a thread since it is a database query
+
+        Returns:
+            List of lines of the stats report
+        """
+        lines = ["Gateway latency: {:.0f}ms".format(self.client.latency * 1000)]
+        watchdog = lib.watchdog.loop_watchdog
+        if watchdog:
+            lines.append("Event loop lag: {:.1f}ms (max {:.1f}ms, {} stalls)".format(watchdog.lag * 1000, watchdog.max_lag * 1000, watchdog.stalls))
+        lines.append("Handlers:")
+        for name, (calls, p50, p99) in self.timings.report().items():
+            lines.append("  {}: {} calls, p50 {:.0f}ms p99 {:.0f}ms".format(name, calls, p50 * 1000, p99 * 1000))
+        lines.append("Lanes:")
+        for lane in self.lanes.values():
+            lines.append("  " + lane.report())
+        if self.remind:
+            pending, next_time = await asyncio.to_thread(self.remind.store.pending)
+            next_due = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(next_time)) if next_time else "never"
+            role = "delivering" if self.remind.store.leader else "standby"
+            lines.append("Reminders ({}): {} pending, next due {}".format(role, pending, next_due))
+        if self.clever:
+            lines.append("Cleverbot: {} conversations".format(len(self.clever.conversations)))
+        lines.append("HTTP:")
+        sessions = {"danbooru": lib.booru_client.session, "waifu": lib.waifu_client.session}
+        if self.clever:
+            sessions["cleverbot"] = self.clever.session
+        for name, session in sessions.items():
+            opened, idle = pool_usage(session)
+            lines.append("  {} pool: {} connections opened, {} idle".format(name, opened, idle))
+        for name, (state, total_requests, total_failures) in get_breaker_states().items():
+            error_rate = total_failures / total_requests * 100 if total_requests else 0.0
+            lines.append("  {}: circuit {}, {} requests, {} errors ({:.1f}%)".format(name, state, total_requests, total_failures, error_rate))
+        lines.append("RSS: {:.1f} MiB".format(get_rss_bytes() / 1048576))
+        caches = ", ".join("{} {}".format(count, name) for name, count in get_cache_counts(self.client).items())
+        lines.append("Caches: {}, {} tracked messages".format(caches, len(tracked_messages)))
+        return lines
 
-    async def handle_reaction_add(self, reaction: "Reaction", user: "User") -> None:
+    async def handle_reaction_add(self, payload: "RawReactionActionEvent") -> None:
         """
-        Handle a reaction add event
+        Handle a (raw) reaction add event. Only reactions on messages the bot is tracking are handled
 
         Args:
-            reaction: Discord reaction object
-            user: Discord user object
+            payload: Discord raw reaction event payload
+        """
+        tracked = tracked_messages.get(payload.message_id)
+        if tracked is None or not self.initialized or payload.user_id == self.user.id or str(payload.emoji) != tracked.emoji:
+            return
+        message = self.client.get_partial_messageable(payload.channel_id).get_partial_message(payload.message_id)
+        lane = self.lanes[self.reaction_lanes.get(tracked.handler, INSTANT)]
+        if not lane.submit(functools.partial(self.call_reaction_handler, message, payload.user_id, tracked)):
+            print("WARNING: {} lane is full, rejected reaction function call for {}".format(lane.name, tracked.emoji))
+
+    async def call_reaction_handler(self, message: "PartialMessage", user_id: int, tracked: TrackedMessage) -> None:
         """
-        pass
+        Call the function handling a reaction on a tracked message
+
+        Args:
+            message: Discord message object which was reacted to
+            user_id: discord id of the user who reacted
+            tracked: the tracked message with the function handling the reaction
+        """
+        function = tracked.handler
+        start = time.perf_counter()
+        try:
+            with running_handler("reaction", tracked.emoji, function):
+                await function(message, user_id, tracked.data)
+        except Exception as e:
+            print("WARNING: Exception thrown during reaction function call for {}".format(tracked.emoji), e)
+        finally:
+            self.timings.record(function.__qualname__, time.perf_counter() - start)
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import resource
+from typing import Dict, List
+
+import discord
+
+from lib.config import get_config
+from lib.tracked_messages import reaction_features_enabled
+
+# Member cache flags which can be enabled from the config, and the gateway intent each one requires
+member_cache_intents = {
+    "voice": "voice_states",
+    "joined": "members",
+}
+
+
+def get_member_cache_flags() -> List[str]:
+    """
+    Parse the configured member cache flags
+
+    Returns:
+        List of member cache flag names (subset of member_cache_intents keys)
+    Raises:
+        RuntimeError when an unknown member cache flag is configured
+    """
+    flags = [flag.strip().lower() for flag in get_config("member_cache_flags").split(",") if flag.strip()]
+    for flag in flags:
+        if flag not in member_cache_intents:
+            raise RuntimeError("Member cache flag {} not supported".format(flag))
+    return flags
+
+
+def build_intents() -> discord.Intents:
+    """
+    Build the gateway intents for the bot, only subscribing to the events the enabled integrations use
+
+    Returns:
+        discord Intents object for the client
+    """
+    intents = discord.Intents.none()
+    # Guild state is needed to resolve channels for replies and reminders
+    intents.guilds = True
+    # Every integration is triggered by a message
+    intents.messages = True
+    intents.message_content = True
+    # Only subscribe to reaction events when something responds to them
+    intents.reactions = reaction_features_enabled()
+    for flag in get_member_cache_flags():
+        setattr(intents, member_cache_intents[flag], True)
+    return intents
+
+
+def create_client() -> discord.Client:
+    """
+    Create the discord client with the cache settings and intents from the config
+
+    Returns:
+        discord Client object (not yet logged in)
+    """
+    intents = build_intents()
+    member_cache_flags = discord.MemberCacheFlags.none()
+    for flag in get_member_cache_flags():
+        setattr(member_cache_flags, flag, True)
+    message_cache_size = int(get_config("message_cache_size"))
+    return discord.Client(
+        intents=intents,
+        # Sent with every identify, so reconnects don't need a seperate presence update
+        activity=discord.Game("Bepis"),
+        max_messages=message_cache_size if message_cache_size > 0 else None,
+        member_cache_flags=member_cache_flags,
+        # Chunking a guild requires the members intent
+        chunk_guilds_at_startup=intents.members and get_config("chunk_guilds_at_startup") == "true",
+    )
+
+
+def get_rss_bytes() -> int:
+    """
+    Get the current resident memory of this process
+
+    Returns:
+        Resident set size in bytes (peak RSS if the current value can't be read)
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_cache_counts(client: discord.Client) -> Dict[str, int]:
+    """
+    Get the number of entries in each discord.py cache. Only the lengths of the caches are read, so this is cheap to call from the event loop.
+    Sizes aren't reported because the shallow size of a cached object leaves out its content, roles, embeds, etc. and says little about the RSS used
+
+    Args:
+        client: Discord client object
+    Returns:
+        Dictionary of cache name to entry count
+    """
+    return {
+        "messages": len(client.cached_messages),
+        "guilds": len(client.guilds),
+        "channels": sum(len(guild.channels) for guild in client.guilds),
+        "members": sum(len(guild.members) for guild in client.guilds),
+        "users": len(client.users),
+        "private_channels": len(client.private_channels),
+        "emojis": len(client.emojis),
+        "stickers": len(client.stickers),
+    }
+
+
+def memory_report(client: discord.Client) -> str:
+    """
+    Build a human readable report of the memory used by the process and the number of entries in each discord.py cache
+
+    Args:
+        client: Discord client object
+    Returns:
+        Multi-line string of the report
+    """
+    lines = ["RSS: {:.1f} MiB".format(get_rss_bytes() / 1048576)]
+    for name, count in get_cache_counts(client).items():
+        lines.append("{}: {} entries".format(name, count))
+    return "\n".join(lines)
+
+
+async def memory_report_loop(client: discord.Client, interval: int) -> None:
+    """
+    Periodically print a memory report for as long as the client is running
+
+    Args:
+        client: Discord client object
+        interval: seconds between reports
+    """
+    await client.wait_until_ready()
+    while not client.is_closed():
+        print("[MEMORY] " + memory_report(client).replace("\n", "\n[MEMORY] "))
+        await asyncio.sleep(interval)
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Tuple
+
+from lib.config import get_config
+from lib.stats import percentile
+
+INSTANT = "instant"
+LOCAL_IO = "local_io"
+EXTERNAL_API = "external_api"
+lane_names = (INSTANT, LOCAL_IO, EXTERNAL_API)
+
+
+class Lane(object):
+    """Bounded queue of handler calls with its own pool of workers, so slow handlers can't delay cheap ones"""
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        """
+        Constructor for the lane. Workers are started on the first submitted job
+
+        Args:
+            name: name of this lane for reporting
+            workers: number of jobs from this lane which can run at the same time
+            queue_size: maximum number of jobs waiting for a worker before new jobs are rejected
+        """
+        self.name = name
+        self.worker_count = workers
+        self.queue: asyncio.Queue[Tuple[float, Callable[[], Awaitable[Any]]]] = asyncio.Queue(queue_size)
+        self.workers: List["asyncio.Task[None]"] = []
+        # Seconds recent jobs waited in the queue before a worker picked them up
+        self.wait_times: Deque[float] = deque(maxlen=256)
+        self.processed = 0
+        self.rejected = 0
+
+    def submit(self, job: Callable[[], Awaitable[Any]]) -> bool:
+        """
+        Queue a job to run in this lane
+
+        Args:
+            job: function taking no arguments which returns the awaitable to run
+        Returns:
+            True if the job was queued, False if the queue is full and the job was rejected
+        """
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+        try:
+            self.queue.put_nowait((time.monotonic(), job))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def stop(self) -> None:
+        """
+        Stop the workers of this lane, cancelling any jobs which are still running
+        """
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def worker(self) -> None:
+        """
+        Coroutine which runs jobs from the queue one at a time
+        """
+        while True:
+            queued_at, job = await self.queue.get()
+            self.wait_times.append(time.monotonic() - queued_at)
+            try:
+                await job()
+            except Exception as e:
+                print("[LANES] WARNING: Exception thrown in {} lane".format(self.name), e)
+            finally:
+                self.processed += 1
+                self.queue.task_done()
+
+    def report(self) -> str:
+        """
+        Build a one line report of the queue depth and wait times of this lane
+
+        Returns:
+            String of the report
+        """
+        waits = sorted(self.wait_times)
+        p50 = percentile(waits, 0.5)
+        p99 = percentile(waits, 0.99)
+        return "{}: depth {}/{}, {} workers, wait p50 {:.0f}ms p99 {:.0f}ms, {} processed, {} rejected".format(
+            self.name, self.queue.qsize(), self.queue.maxsize, self.worker_count, p50 * 1000, p99 * 1000, self.processed, self.rejected
+        )
+
+
+def create_lanes() -> Dict[str, Lane]:
+    """
+    Create every lane with the worker and queue limits from the config
+
+    Returns:
+        Dictionary of lane name to Lane
+    """
+    return {name: Lane(name, int(get_config("lane_{}_workers".format(name))), int(get_config("lane_{}_queue".format(name)))) for name in lane_names}
+
+
+async def lane_report_loop(lanes: Dict[str, Lane], interval: int) -> None:
+    """
+    Periodically print the report of every lane
+
+    Args:
+        lanes: Dictionary of lane name to Lane
+        interval: seconds between reports
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for lane in lanes.values():
+            print("[LANES] " + lane.report())
@@ -1,18 +1,20 @@
 import asyncio
-import heapq
+import concurrent.futures
 import os
 import pickle
 import threading
 import time
-from typing import TYPE_CHECKING, Any
+from typing import TYPE_CHECKING, Any, Coroutine, List, Tuple, TypeVar
 
 if TYPE_CHECKING:
-    from discord import Client, Message
+    from discord import Client, Message, PartialMessage
     from discord.abc import Messageable
 
 import discord
 
 from lib.config import get_config
+from lib.remind_store import ReminderStore, RemindEvent
+from lib.tracked_messages import tracked_messages
 from lib.utils import friendly_name_of_messageable, get_params
 
 usage = """```Usage: remind <user/channel> <number> <time_unit> <message>
@@ -35,30 +37,12 @@ offset_map = {
     "weeks": 604800,
 }
 
-lock = threading.Lock()
+T = TypeVar("T")
 
-
-class RemindEvent(object):
-    """Data related to a reminder event"""
-
-    def __init__(self, user_id: int, time: float, message: str, channel_id: int = 0):
-        """
-        Constructor for the reminder event
-
-        Args:
-            user_id: discord user_id for this reminder
-            time: unix timestamp to remind this user
-            message: reminder message to send for this event
-        """
-        self.user_id = user_id
-        self.time = time
-        self.message = message
-        if channel_id:
-            self.channel_id = channel_id
-
-    # Needed for heapq since it uses builtin list.sort
-    def __lt__(self, other: "RemindEvent") -> bool:
-        return self.time < other.time
+# Discord's maximum message length
+max_message_length = 2000
+# Reacting with this to a delivered reminder sends it again later
+snooze_emoji = "\u23f0"
 
 
 class Reminder(object):
@@ -77,24 +61,50 @@ class Reminder(object):
             raise RuntimeError("Discord client passed into Reminder client was not ready for use")
         self.client = client
         self.event_loop = asyncio.get_event_loop()
-        self.save_time = int(get_config("remind_save_time"))
-        self.file = os.path.join(os.getcwd(), "reminders.bin")
-        # Create the reminders file if it doesn't exist
-        if not os.path.exists(self.file):
-            open(self.file, "a").close()
-        self.init_from_file()
+        self.coalesce_window = float(get_config("remind_coalesce_window"))
+        self.snooze = get_config("remind_snooze") == "true"
+        self.snooze_time = int(get_config("remind_snooze_time"))
+        self.store = ReminderStore(os.path.join(os.getcwd(), get_config("remind_database")), float(get_config("remind_lease_time")))
+        self.migrate_file(os.path.join(os.getcwd(), "reminders.bin"))
+        self.stopped = threading.Event()
         self.runner = threading.Thread(target=self.thread_loop)
+
+    def start(self) -> None:
+        """
+        Start the thread that sends reminders
+        """
         self.runner.start()
 
-    def init_from_file(self) -> None:
+    def stop(self) -> None:
         """
-        Read jobs from a file on initialization
+        Stop the thread that sends reminders and hand delivery over to another instance
         """
-        f = open(self.file, "rb")
+        self.stopped.set()
+        if self.runner.is_alive():
+            self.runner.join()
+        self.store.release_lease()
+
+    def migrate_file(self, path: str) -> None:
+        """
+        Move reminders from the file used by older versions of the bot into the reminder store
+
+        Args:
+            path: path of the old pickled reminders file
+        """
+        migrated = path + ".migrated"
         try:
-            self.jobs = pickle.load(f)
-        except EOFError:
-            self.jobs = []
+            # Renaming first means only one instance can migrate the file
+            os.replace(path, migrated)
+        except FileNotFoundError:
+            return
+        with open(migrated, "rb") as f:
+            try:
+                jobs = pickle.load(f)
+            except EOFError:
+                jobs = []
+        # Reminders from older versions may not have a channel id
+        self.store.add([RemindEvent(job.user_id, job.time, job.message, getattr(job, "channel_id", 0)) for job in jobs])
+        print("[REMINDER] Migrated {} reminder(s) from {}".format(len(jobs), path))
 
     async def handle_remind(self, message: "Message", trigger_type: str, trigger: str) -> None:
         """
@@ -153,48 +163,163 @@ class Reminder(object):
         remind_time = time.time() + (remind_offset * remind_multiplier)
         # Get the raw message after params
         raw_message = message.content[message.content.find(params[2]) + len(params[2]) :]
-        with lock:
-            heapq.heappush(self.jobs, RemindEvent(remind_user_id, remind_time, raw_message, remind_channel_id))
+        await asyncio.to_thread(self.store.add, [RemindEvent(remind_user_id, remind_time, raw_message, remind_channel_id)])
         await message.channel.send("ok")
 
+    async def deliver(self, messageable: "Messageable", group: List[RemindEvent]) -> None:
+        """
+        Send a group of reminders for the same recipient, tracking the last message sent so it can be snoozed
+
+        Args:
+            messageable: Discord user or channel to send the reminders to
+            group: List of reminders to send
+        """
+        message = None
+        sent = 0
+        for content, finished in combine_messages([event.message for event in group]):
+            try:
+                message = await messageable.send(content)
+            except Exception:
+                # Only the reminders which weren't fully sent yet are left in the store to be tried again
+                if sent:
+                    await asyncio.to_thread(self.store.complete, group[:sent])
+                raise
+            sent = finished
+        if message is not None and self.snooze:
+            try:
+                await message.add_reaction(snooze_emoji)
+            except discord.HTTPException as e:
+                # The reminder was still sent; it just can't be snoozed
+                print("[REMINDER] WARNING: Couldn't add snooze reaction to reminder: {}".format(e))
+                return
+            tracked_messages.track(message.id, snooze_emoji, self.handle_snooze, group)
+
+    async def handle_snooze(self, message: "PartialMessage", user_id: int, group: List[RemindEvent]) -> None:
+        """
+        Handle a snooze reaction on a delivered reminder by scheduling it to be sent again
+
+        Args:
+            message: Discord message object of the delivered reminder
+            user_id: discord id of the user who reacted
+            group: List of reminders delivered in the message
+        """
+        # Each delivery can only be snoozed once; the snoozed reminder can be snoozed again when it's sent
+        tracked_messages.untrack(message.id)
+        remind_time = time.time() + self.snooze_time
+        await asyncio.to_thread(self.store.add, [RemindEvent(event.user_id, remind_time, event.message, event.channel_id) for event in group])
+        await message.channel.send("Snoozed for {} minute(s)".format(round(self.snooze_time / 60)))
+
     def thread_loop(self) -> None:
         """
-        The loop for the thread that handles sending reminders
+        The loop for the thread that handles sending reminders. Only the instance holding the delivery lease sends them
         """
-        count = 0
-        while True:
+        while not self.stopped.wait(1):
             try:
-                time.sleep(1)
-                count += 1
-                while self.jobs and self.jobs[0].time < time.time():
-                    with lock:
-                        current = heapq.heappop(self.jobs)
-                    # For backwards compatibility and reminders that don't have a channel id
-                    if not hasattr(current, "channel_id"):
-                        current.channel_id = 0
-                    messageable: "Messageable" = None  # type: ignore
+                # The lease is renewed before claiming each group, so a standby instance can't take over part way through a burst of reminders
+                while not self.stopped.is_set() and self.store.renew_lease():
+                    group = self.store.claim_next_group(self.coalesce_window)
+                    if group is None:
+                        break
+                    # A failure for one recipient must not hold up the other groups
                     try:
-                        if current.channel_id:
-                            # We are sure this channel is messageable because it's the same channel ID where we originally received a remind message; coerce type
-                            messageable = asyncio.run_coroutine_threadsafe(self.client.fetch_channel(current.channel_id), self.event_loop).result()  # type: ignore
-                        else:
-                            messageable = asyncio.run_coroutine_threadsafe(self.client.fetch_user(current.user_id), self.event_loop).result()
-                    except discord.NotFound:
-                        print(
-                            "[REMINDER] WARNING: Couldn't locate {} with id {} for reminder. Ignoring this reminder (message was:{})".format(
-                                "channel" if current.channel_id else "user",
-                                current.channel_id if current.channel_id else current.user_id,
-                                current.message,
-                            )
-                        )
+                        self.send_group(group)
+                    except Exception as e:
+                        # The claim on the group expires after the lease time, and then it is sent again
+                        print("[REMINDER] WARNING: Couldn't send {} reminder(s), trying again later: {}".format(len(group), e))
                         continue
-                    print("Sending reminder to {}".format(friendly_name_of_messageable(messageable)))
-                    # Fire off reminder message when time in the main thread
-                    asyncio.run_coroutine_threadsafe(messageable.send(current.message), self.event_loop)
-                # Occasionally backup to disk
-                if count >= self.save_time:
-                    with open(self.file, "wb") as f:
-                        pickle.dump(self.jobs, f)
-                    count = 0
+                    self.store.complete(group)
             except Exception as e:
                 print("Exception in Reminder thread loop: {}".format(e))
+
+    def run_on_loop(self, coro: Coroutine[Any, Any, T], group: List[RemindEvent]) -> T:
+        """
+        Run a coroutine in the main thread and wait for it, keeping the delivery lease and the claim on a group of reminders alive while it runs
+
+        Args:
+            coro: coroutine to run
+            group: List of claimed reminders the coroutine is delivering
+        Returns:
+            The result of the coroutine
+        Raises:
+            RuntimeError when the lease was lost while waiting. The coroutine is cancelled since another instance may now deliver the group
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.event_loop)
+        while True:
+            done, _ = concurrent.futures.wait([future], timeout=self.store.lease_time / 3)
+            if done:
+                return future.result()
+            try:
+                held = self.store.renew_lease() and self.store.extend_claim(group)
+            except Exception:
+                future.cancel()
+                raise
+            if not held:
+                future.cancel()
+                raise RuntimeError("Lost the reminder delivery lease while sending")
+
+    def send_group(self, group: List[RemindEvent]) -> None:
+        """
+        Find the recipient of a group of reminders and send them from the main thread, waiting for them to be sent.
+        Reminders for a recipient which no longer exists or can't be reached are dropped
+
+        Args:
+            group: List of reminders for the same recipient
+        Raises:
+            discord.HTTPException (other than NotFound or Forbidden) when the recipient couldn't be fetched or the reminders couldn't be sent,
+            which may succeed if tried again
+        """
+        current = group[0]
+        messageable: "Messageable" = None  # type: ignore
+        try:
+            if current.channel_id:
+                # We are sure this channel is messageable because it's the same channel ID where we originally received a remind message; coerce type
+                messageable = self.run_on_loop(self.client.fetch_channel(current.channel_id), group)  # type: ignore
+            else:
+                messageable = self.run_on_loop(self.client.fetch_user(current.user_id), group)
+        except (discord.NotFound, discord.Forbidden) as e:
+            print(
+                "[REMINDER] WARNING: Couldn't locate {} with id {} for reminder ({}). Ignoring {} reminder(s) (messages were:{})".format(
+                    "channel" if current.channel_id else "user",
+                    current.channel_id if current.channel_id else current.user_id,
+                    e,
+                    len(group),
+                    [event.message for event in group],
+                )
+            )
+            return
+        print("Sending {} reminder(s) to {}".format(len(group), friendly_name_of_messageable(messageable)))
+        # Fire off reminder messages when time in the main thread
+        try:
+            self.run_on_loop(self.deliver(messageable, group), group)
+        except (discord.NotFound, discord.Forbidden) as e:
+            # e.g. the user doesn't accept DMs from the bot; trying again won't help
+            print("[REMINDER] WARNING: Not allowed to send reminder ({}). Ignoring {} reminder(s)".format(e, len(group)))
+
+
+def combine_messages(messages: List[str]) -> List[Tuple[str, int]]:
+    """
+    Combine reminder messages into as few discord messages as possible, one reminder per line
+
+    Args:
+        messages: List of reminder messages
+    Returns:
+        List of (message content, number of reminder messages fully sent once this one is sent) tuples. Each message content is no longer than
+        discord's maximum message length
+    """
+    combined: List[Tuple[str, int]] = []
+    current = ""
+    for index, message in enumerate(messages):
+        message = message.strip() if len(messages) > 1 else message
+        # Split up single reminders that are too long on their own
+        parts = [message[i : i + max_message_length] for i in range(0, len(message), max_message_length)] or [message]
+        for part in parts:
+            if current and len(current) + 1 + len(part) <= max_message_length:
+                current += "\n" + part
+            else:
+                if current:
+                    # Reminders before this one are complete, this one isn't started or isn't finished
+                    combined.append((current, index))
+                current = part
+    if current:
+        combined.append((current, len(messages)))
+    return combined
@@ -0,0 +1,199 @@
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Name of the lease held by the instance which delivers reminders
+lease_name = "reminder_delivery"
+
+
+class RemindEvent(object):
+    """Data related to a reminder event"""
+
+    def __init__(self, user_id: int, time: float, message: str, channel_id: int = 0, row_id: int = 0):
+        """
+        Constructor for the reminder event
+
+        Args:
+            user_id: discord user_id for this reminder
+            time: unix timestamp to remind this user
+            message: reminder message to send for this event
+            channel_id: discord channel_id for this reminder (0 to remind the user directly)
+            row_id: id of this reminder in the reminder store (0 if it hasn't been saved)
+        """
+        self.user_id = user_id
+        self.time = time
+        self.message = message
+        self.channel_id = channel_id
+        self.row_id = row_id
+
+
+class ReminderStore(object):
+    """Reminders kept in a sqlite database which can be shared by several bot instances. A lease elects the one instance which delivers them"""
+
+    def __init__(self, path: str, lease_time: float):
+        """
+        Constructor for the reminder store, creating the database if it doesn't exist
+
+        Args:
+            path: path of the sqlite database file
+            lease_time: seconds a delivery lease lasts without being renewed before another instance can take over
+        """
+        self.path = path
+        self.lease_time = lease_time
+        self.instance_id = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.leader = False
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            # Lets instances read while another one is writing
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            conn.close()
+        with self.transaction() as conn:
+            # claimed_until is when a delivery which claimed the reminder is given up on, so it can be retried
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS reminders (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, time REAL NOT NULL, message TEXT NOT NULL, claimed_until REAL NOT NULL DEFAULT 0)"
+            )
+            # Databases created before reminders were claimed don't have the column
+            if "claimed_until" not in [column[1] for column in conn.execute("PRAGMA table_info(reminders)")]:
+                conn.execute("ALTER TABLE reminders ADD COLUMN claimed_until REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS reminders_time ON reminders (time)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)")
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a connection to the database in a write transaction, which is committed when the block exits (or rolled back on exception)
+
+        Returns:
+            Context manager of the sqlite connection
+        """
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def add(self, events: List[RemindEvent]) -> None:
+        """
+        Save new reminders
+
+        Args:
+            events: List of reminders to save
+        """
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO reminders (user_id, channel_id, time, message) VALUES (?, ?, ?, ?)",
+                [(event.user_id, event.channel_id, event.time, event.message) for event in events],
+            )
+
+    def pending(self) -> Tuple[int, Optional[float]]:
+        """
+        Get the pending reminders
+
+        Returns:
+            Tuple of (number of pending reminders, unix timestamp of the next one or None)
+        """
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            count, next_time = conn.execute("SELECT COUNT(*), MIN(time) FROM reminders").fetchone()
+        finally:
+            conn.close()
+        return count, next_time
+
+    def _holds_lease(self, conn: sqlite3.Connection, now: float) -> bool:
+        row = conn.execute("SELECT holder, expires FROM leases WHERE name = ?", (lease_name,)).fetchone()
+        return row is not None and row[0] == self.instance_id and row[1] > now
+
+    def renew_lease(self) -> bool:
+        """
+        Take or renew the delivery lease. The lease is only taken over from another instance once it has expired
+
+        Returns:
+            True if this instance holds the lease and should deliver reminders, False otherwise
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT holder, expires FROM leases WHERE name = ?", (lease_name,)).fetchone()
+            leader = row is None or row[0] == self.instance_id or row[1] < now
+            if leader:
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)", (lease_name, self.instance_id, now + self.lease_time)
+                )
+        if leader != self.leader:
+            print("[REMINDER] {} is now {} reminders".format(self.instance_id, "delivering" if leader else "on standby for"))
+        self.leader = leader
+        return leader
+
+    def release_lease(self) -> None:
+        """
+        Give up the delivery lease so a standby instance can take over right away
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (lease_name, self.instance_id))
+        self.leader = False
+
+    def claim_next_group(self, coalesce_window: float) -> Optional[List[RemindEvent]]:
+        """
+        Claim and return the next group of due reminders for the same recipient. Nothing is returned unless this instance holds the lease.
+        Reminders for the same recipient which are due within the coalesce window are included with the due ones.
+        Claimed reminders stay in the store until they are completed; if that doesn't happen within the lease time (the delivery failed or the
+        instance died) they are claimed again, unless the claim is extended
+
+        Args:
+            coalesce_window: seconds after a due reminder in which reminders for the same recipient are sent with it
+        Returns:
+            List of reminders for the same recipient sorted by time, or None if no reminders are due
+        """
+        now = time.time()
+        groups: Dict[Tuple[int, int], List[RemindEvent]] = {}
+        with self.transaction() as conn:
+            # Checked in the same transaction as the claim, so an instance which lost its lease can't deliver reminders twice
+            if not self._holds_lease(conn, now):
+                return None
+            rows = conn.execute(
+                "SELECT id, user_id, channel_id, time, message FROM reminders WHERE time < ? AND claimed_until < ? ORDER BY time",
+                (now + coalesce_window, now),
+            ).fetchall()
+            for row_id, user_id, channel_id, remind_time, message in rows:
+                groups.setdefault((channel_id, user_id), []).append(RemindEvent(user_id, remind_time, message, channel_id, row_id))
+            # Only deliver a group once its first reminder is due; the rest are left to wait
+            due = next((group for group in groups.values() if group[0].time < now), None)
+            if due is not None:
+                conn.executemany("UPDATE reminders SET claimed_until = ? WHERE id = ?", [(now + self.lease_time, event.row_id) for event in due])
+        return due
+
+    def extend_claim(self, events: List[RemindEvent]) -> bool:
+        """
+        Extend the claim on reminders which are still being delivered by another lease time
+
+        Args:
+            events: List of claimed reminders
+        Returns:
+            True if the claim was extended, False if this instance no longer holds the lease (and another instance may claim them)
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            if not self._holds_lease(conn, now):
+                return False
+            conn.executemany("UPDATE reminders SET claimed_until = ? WHERE id = ?", [(now + self.lease_time, event.row_id) for event in events])
+        return True
+
+    def complete(self, events: List[RemindEvent]) -> None:
+        """
+        Remove claimed reminders which were delivered (or can never be delivered)
+
+        Args:
+            events: List of reminders to remove
+        """
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM reminders WHERE id = ?", [(event.row_id,) for event in events])
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+import unittest
+
+from lib.remind_store import ReminderStore, RemindEvent
+
+lease_time = 0.3
+
+
+class TestReminderStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "reminders.db")
+        self.leader = ReminderStore(path, lease_time)
+        self.standby = ReminderStore(path, lease_time)
+        due = time.time() - 1
+        self.leader.add([RemindEvent(1, due, "x"), RemindEvent(2, due, "y")])
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_only_lease_holder_claims(self) -> None:
+        self.assertTrue(self.leader.renew_lease())
+        self.assertFalse(self.standby.renew_lease())
+        self.assertIsNone(self.standby.claim_next_group(0))
+        self.assertIsNotNone(self.leader.claim_next_group(0))
+
+    def test_claims_one_group_at_a_time(self) -> None:
+        self.leader.renew_lease()
+        first = self.leader.claim_next_group(0)
+        second = self.leader.claim_next_group(0)
+        assert first is not None and second is not None
+        self.assertEqual([[event.message for event in first], [event.message for event in second]], [["x"], ["y"]])
+        self.assertIsNone(self.leader.claim_next_group(0))
+
+    def test_standby_does_not_claim_while_claim_is_extended(self) -> None:
+        self.leader.renew_lease()
+        group = self.leader.claim_next_group(0)
+        assert group is not None
+        # A slow delivery which keeps renewing its lease and claim for longer than the lease time
+        for _ in range(4):
+            time.sleep(lease_time / 3)
+            self.assertTrue(self.leader.renew_lease())
+            self.assertTrue(self.leader.extend_claim(group))
+        self.assertFalse(self.standby.renew_lease())
+        self.assertIsNone(self.standby.claim_next_group(0))
+
+    def test_standby_takes_over_after_lease_expires(self) -> None:
+        self.leader.renew_lease()
+        group = self.leader.claim_next_group(0)
+        assert group is not None
+        # The leader stops renewing (e.g. it died while sending)
+        time.sleep(lease_time + 0.1)
+        self.assertTrue(self.standby.renew_lease())
+        self.assertFalse(self.leader.extend_claim(group))
+        self.assertFalse(self.leader.renew_lease())
+        self.assertIsNone(self.leader.claim_next_group(0))
+        claimed = []
+        while (next_group := self.standby.claim_next_group(0)) is not None:
+            claimed.append([event.message for event in next_group])
+            self.standby.complete(next_group)
+        self.assertEqual(sorted(claimed), [["x"], ["y"]])
+        self.assertEqual(self.standby.pending(), (0, None))
+
+    def test_failed_group_is_claimed_again_after_claim_expires(self) -> None:
+        self.leader.renew_lease()
+        group = self.leader.claim_next_group(0)
+        assert group is not None
+        self.leader.complete(group)
+        failed = self.leader.claim_next_group(0)
+        assert failed is not None
+        self.assertIsNone(self.leader.claim_next_group(0))
+        time.sleep(lease_time + 0.1)
+        self.leader.renew_lease()
+        retried = self.leader.claim_next_group(0)
+        assert retried is not None
+        self.assertEqual([event.row_id for event in retried], [event.row_id for event in failed])
+
+
+if __name__ == "__main__":
+    unittest.main()
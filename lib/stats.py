@@ -0,0 +1,88 @@
+from collections import deque
+from typing import Deque, Dict, Sequence, Tuple
+
+import requests
+
+# Number of recent calls kept for each handler's latency percentiles
+latency_window = 256
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """
+    Get a percentile of some values
+
+    Args:
+        values: sorted values
+        fraction: percentile to get as a decimal (i.e. 0.99 for p99)
+    Returns:
+        The value at that percentile, or 0 if there are no values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class HandlerTimings(object):
+    """Recent latencies of each message handler"""
+
+    def __init__(self) -> None:
+        """
+        Constructor for the handler timings
+        """
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.calls: Dict[str, int] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        """
+        Record one call of a handler
+
+        Args:
+            name: name of the handler function
+            seconds: how long the call took
+        """
+        latencies = self.latencies.get(name)
+        if latencies is None:
+            latencies = deque(maxlen=latency_window)
+            self.latencies[name] = latencies
+            self.calls[name] = 0
+        latencies.append(seconds)
+        self.calls[name] += 1
+
+    def report(self) -> Dict[str, Tuple[int, float, float]]:
+        """
+        Get the latency percentiles of each handler
+
+        Returns:
+            Dictionary of handler name to a tuple of (total calls, p50 seconds, p99 seconds)
+        """
+        result = {}
+        for name, latencies in self.latencies.items():
+            values = sorted(latencies)
+            result[name] = (self.calls[name], percentile(values, 0.5), percentile(values, 0.99))
+        return result
+
+
+def pool_usage(session: requests.Session) -> Tuple[int, int]:
+    """
+    Get the connection pool usage of a requests session
+
+    Args:
+        session: requests session to inspect
+    Returns:
+        Tuple of (connections opened, idle connections ready for reuse)
+    """
+    opened = 0
+    idle = 0
+    for adapter in session.adapters.values():
+        manager = getattr(adapter, "poolmanager", None)
+        if manager is None:
+            continue
+        for key in manager.pools.keys():
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            if pool.pool is not None:
+                # Pools are pre-filled with None placeholders for connections which haven't been opened yet
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+    return opened, idle
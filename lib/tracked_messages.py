@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional
+
+from lib.config import get_config
+
+if TYPE_CHECKING:
+    from discord import PartialMessage
+
+
+class TrackedMessage(object):
+    """A message sent by the bot which responds to a reaction"""
+
+    def __init__(self, emoji: str, handler: Callable[["PartialMessage", int, Any], Awaitable[None]], data: Any):
+        """
+        Constructor for the tracked message
+
+        Args:
+            emoji: the reaction emoji which triggers the handler
+            handler: function taking in the params (message, user_id, data) to call when the reaction is added
+            data: data about the message to pass to the handler
+        """
+        self.emoji = emoji
+        self.handler = handler
+        self.data = data
+
+
+class TrackedMessages(object):
+    """Bounded index of messages the bot is tracking reactions on. The least recently used message is dropped when full"""
+
+    def __init__(self, max_size: int):
+        """
+        Constructor for the tracked message index
+
+        Args:
+            max_size: maximum number of messages to track
+        """
+        self.max_size = max_size
+        self.messages: OrderedDict[int, TrackedMessage] = OrderedDict()
+
+    def track(self, message_id: int, emoji: str, handler: Callable[["PartialMessage", int, Any], Awaitable[None]], data: Any) -> None:
+        """
+        Start tracking reactions on a message
+
+        Args:
+            message_id: discord id of the message
+            emoji: the reaction emoji which triggers the handler
+            handler: function taking in the params (message, user_id, data) to call when the reaction is added
+            data: data about the message to pass to the handler
+        """
+        self.messages[message_id] = TrackedMessage(emoji, handler, data)
+        self.messages.move_to_end(message_id)
+        if len(self.messages) > self.max_size:
+            self.messages.popitem(last=False)
+
+    def get(self, message_id: int) -> Optional[TrackedMessage]:
+        """
+        Get a tracked message, marking it as recently used
+
+        Args:
+            message_id: discord id of the message
+        Returns:
+            TrackedMessage, or None if the message isn't tracked
+        """
+        tracked = self.messages.get(message_id)
+        if tracked is not None:
+            self.messages.move_to_end(message_id)
+        return tracked
+
+    def untrack(self, message_id: int) -> None:
+        """
+        Stop tracking reactions on a message
+
+        Args:
+            message_id: discord id of the message
+        """
+        self.messages.pop(message_id, None)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+
+def reaction_features_enabled() -> bool:
+    """
+    Check if any integration which responds to reactions is enabled
+
+    Returns:
+        True if reaction events are needed, False otherwise
+    """
+    return get_config("danbooru_reroll") == "true" or (get_config("remind_enabled") == "true" and get_config("remind_snooze") == "true")
+
+
+tracked_messages = TrackedMessages(int(get_config("tracked_message_limit")))
@@ -1,5 +1,6 @@
 # WARNING: This integration currently does not work due to anti-bot scraping protections by mywaifulist
 # It would be possible to fix this integration with paid API access/integration in the future
+import asyncio
 from typing import TYPE_CHECKING
 
 import requests
@@ -10,6 +11,14 @@ if TYPE_CHECKING:
     from discord.abc import MessageableChannel
 
 error_message = "There was an error fetching a waifu! Sorry!"
+session = requests.Session()
+
+
+def close() -> None:
+    """
+    Close the pooled HTTP connections of the waifu client
+    """
+    session.close()
 
 
 async def handle_waifu(message: "Message", trigger_type: str, trigger: str) -> None:
@@ -35,7 +44,7 @@ async def process_request(channel: "MessageableChannel", trigger: str) -> None:
     """
     # Python do-while. Will return out of loop when necessary
     while True:
-        r = requests.get("https://mywaifulist.moe/random")
+        r = await asyncio.to_thread(session.get, "https://mywaifulist.moe/random")
         # Handle bad response
         if r.status_code < 200 or r.status_code >= 300:
             await channel.send(error_message)
@@ -44,7 +53,7 @@ async def process_request(channel: "MessageableChannel", trigger: str) -> None:
             return
         try:
             # Parse html for the waifu id
-            page = BeautifulSoup(r.text, "html.parser")
+            page = await asyncio.to_thread(BeautifulSoup, r.text, "html.parser")
             waifu_core = page.find("waifu-core")
             if waifu_core is None:
                 await channel.send(error_message)
@@ -52,7 +61,9 @@ async def process_request(channel: "MessageableChannel", trigger: str) -> None:
                 return
             waifu_id = waifu_core.get(":waifu-id")
             # Now query the api for the waifu information
-            r = requests.get("https://mywaifulist.moe/api/waifu/{}".format(waifu_id), headers={"X-Requested-With": "XMLHttpRequest"})
+            r = await asyncio.to_thread(
+                session.get, "https://mywaifulist.moe/api/waifu/{}".format(waifu_id), headers={"X-Requested-With": "XMLHttpRequest"}
+            )
             if r.status_code < 200 or r.status_code >= 300:
                 await channel.send(error_message)
                 print("Warning: Response {} from mywaifulist api".format(r.status_code))
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from types import FrameType
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from lib.config import get_config
+
+# Handler each task is running, so the handler involved in a stall can be named
+running_handlers: Dict["asyncio.Task[Any]", str] = {}
+
+
+@contextmanager
+def running_handler(trigger_type: str, trigger: str, function: Callable[..., Any]) -> Iterator[None]:
+    """
+    Record the handler the current task is running for the duration of the block. Used by functions which call message (or reaction) handlers
+
+    Args:
+        trigger_type: the trigger type ('author', 'first_word', 'contains', or 'reaction')
+        trigger: the relevant string that triggered this call
+        function: handler function being called
+    """
+    task = asyncio.current_task()
+    if task is not None:
+        running_handlers[task] = "{} trigger '{}' handled by {}".format(trigger_type, trigger, getattr(function, "__qualname__", function))
+    try:
+        yield
+    finally:
+        if task is not None:
+            running_handlers.pop(task, None)
+
+
+def describe_handler(loop: asyncio.AbstractEventLoop) -> str:
+    """
+    Find the handler the task currently running on an event loop is in. Safe to call from other threads
+
+    Args:
+        loop: event loop to check
+    Returns:
+        String naming the trigger and handler function, or 'unknown' if not running in a handler
+    """
+    task = asyncio.current_task(loop)
+    if task is None:
+        return "unknown"
+    return running_handlers.get(task, "unknown")
+
+
+def fold_stack(frame: Optional[FrameType]) -> str:
+    """
+    Format a stack in the 'folded' format used by flame graph tools (outermost frame first, ';' seperated)
+
+    Args:
+        frame: innermost frame of the stack
+    Returns:
+        String of the folded stack
+    """
+    names = []
+    while frame is not None:
+        names.append("{} ({}:{})".format(frame.f_code.co_qualname, os.path.basename(frame.f_code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class LoopWatchdog(object):
+    """Measures event loop lag and reports callbacks which block the event loop"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float, stall_threshold: float):
+        """
+        Constructor for the watchdog. Must be called from the event loop thread
+
+        Args:
+            loop: running event loop to watch
+            interval: seconds between lag measurements
+            stall_threshold: seconds the loop can be blocked before the blocking stack is printed
+        """
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.heartbeat = time.monotonic()
+        self.profiling = False
+        self.task: Optional["asyncio.Task[None]"] = None
+        self.runner = threading.Thread(target=self.thread_loop, daemon=True)
+
+    def start(self) -> None:
+        """
+        Start measuring lag on the event loop and watching for stalls from a seperate thread
+        """
+        self.task = self.loop.create_task(self.measure_loop())
+        self.runner.start()
+
+    async def measure_loop(self) -> None:
+        """
+        Coroutine measuring how late the event loop wakes up from sleeps
+        """
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            self.lag = max(self.heartbeat - start - self.interval, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+
+    def thread_loop(self) -> None:
+        """
+        The loop for the thread that reports the stack of the event loop thread when it stops responding
+        """
+        reported = 0.0
+        while True:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # Only report each stall once
+            if blocked < self.stall_threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            print(
+                "[WATCHDOG] WARNING: Event loop blocked for at least {:.2f}s in {}\n{}".format(
+                    blocked, describe_handler(self.loop), "".join(traceback.format_stack(frame)).rstrip()
+                )
+            )
+
+    def start_profile(self) -> None:
+        """
+        Start sampling the stack of the event loop thread in the background, writing the profile to a file in the working directory
+        """
+        if self.profiling:
+            print("[WATCHDOG] Profile already in progress")
+            return
+        self.profiling = True
+        duration = float(get_config("profile_duration"))
+        sample_interval = float(get_config("profile_sample_interval"))
+        path = os.path.join(os.getcwd(), "profile-{}.folded".format(int(time.time())))
+        print("[WATCHDOG] Profiling for {}s into {}".format(duration, path))
+        threading.Thread(target=self.profile, args=(duration, sample_interval, path), daemon=True).start()
+
+    def profile(self, duration: float, sample_interval: float, path: str) -> None:
+        """
+        Sample the stack of the event loop thread and write the sample counts in the folded stack format
+
+        Args:
+            duration: seconds to sample for
+            sample_interval: seconds between samples
+            path: file to write the profile to
+        """
+        try:
+            samples: Counter[str] = Counter()
+            end = time.monotonic() + duration
+            while time.monotonic() < end:
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    samples[fold_stack(frame)] += 1
+                del frame
+                time.sleep(sample_interval)
+            with open(path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write("{} {}\n".format(stack, count))
+            print("[WATCHDOG] Wrote profile of {} samples to {}".format(sum(samples.values()), path))
+        except Exception as e:
+            print("[WATCHDOG] Error while profiling: {}".format(e))
+        finally:
+            self.profiling = False
+
+
+loop_watchdog: Optional[LoopWatchdog] = None
+
+
+def start_watchdog(loop: asyncio.AbstractEventLoop) -> Optional[LoopWatchdog]:
+    """
+    Start the event loop watchdog if it is enabled in the config. Must be called from the event loop thread
+
+    Args:
+        loop: running event loop to watch
+    Returns:
+        The running LoopWatchdog, or None if it is disabled
+    """
+    global loop_watchdog
+    interval = float(get_config("watchdog_interval"))
+    if interval > 0 and loop_watchdog is None:
+        loop_watchdog = LoopWatchdog(loop, interval, float(get_config("watchdog_stall_threshold")))
+        loop_watchdog.start()
+    return loop_watchdog